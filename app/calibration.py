@@ -0,0 +1,283 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from app.configured_shot import simulate_batch
+from app.models import FullSimulationConfig, SimulationConfig
+from app.shot_gradients import FIELD_NAMES, simulate_with_gradients
+
+
+# Hand-entered constants of the model which can be fitted, the design factors are set per shot instead
+CALIBRATABLE_PARAMETERS = (
+    "g",
+    "spring_constant",
+    "moment_of_inertia",
+    "cup_mass",
+    "axle_distance",
+    "bungee_length_no_load",
+    "height_offset"
+)
+
+# Measured outputs the model is fitted to, missing (NaN) measurements are skipped
+MEASURED_OUTPUTS = ("x_ground", "max_height")
+
+
+@dataclass
+class CalibrationResult:
+    unit: str
+    parameters: dict                    # Fitted values of the chosen parameters
+    initial_parameters: dict
+    residual_rms: float                 # Root mean square of residuals at the fitted values, in m
+    iterations: int
+    converged: bool
+    standard_errors: dict = field(default_factory=dict)
+
+    def config(self, base: Optional[SimulationConfig] = None) -> SimulationConfig:
+        """
+        Returns the configuration of the unit with the fitted parameters
+        """
+        base = base or SimulationConfig()
+        return base.model_copy(update=self.parameters)
+
+
+def load_measurements(path: str) -> pd.DataFrame:
+    """
+    Reads measured shots. Every row is a shot with the inputs of configured_shot.simulate
+    (missing columns are taken from FullSimulationConfig defaults) and measured 'x_ground' and / or 'max_height' in m.
+    An optional 'unit' column tells which physical catapult the shot was measured on.
+    :param path: str, path to the csv file
+    :return: measurements_df: pd.DataFrame
+    """
+    measurements_df = pd.read_csv(path, encoding="utf-8-sig")
+    missing_outputs = [name for name in MEASURED_OUTPUTS if name not in measurements_df.columns]
+    assert len(missing_outputs) < len(MEASURED_OUTPUTS), f"Measurements should contain one of {MEASURED_OUTPUTS}."
+
+    defaults = FullSimulationConfig().model_dump()
+    for name, value in defaults.items():
+        if name.startswith("delta_"):
+            continue
+        if name not in measurements_df.columns:
+            measurements_df[name] = value
+
+    return measurements_df
+
+
+def get_residuals_function(
+        measurements_df: pd.DataFrame,
+        parameter_names: list[str],
+        initial: np.ndarray,
+        scale: np.ndarray
+):
+    """
+    Returns a function computing residuals (simulated - measured) of all shots and, on demand, their Jacobian.
+    Parameters are expressed relatively to their scales: value = initial + scale * theta
+    :param measurements_df: pd.DataFrame, measured shots of one unit
+    :param parameter_names: list[str], names of fitted parameters
+    :param initial: np.ndarray, initial values of fitted parameters
+    :param scale: np.ndarray, scales of fitted parameters
+    :return: residuals: Callable[[np.ndarray, bool], np.ndarray | tuple[np.ndarray, np.ndarray]],
+        theta (p,) -> residuals (n_residuals,) or (residuals, jacobian (n_residuals, p))
+    """
+    inputs = {
+        name: measurements_df[name].to_numpy(dtype=np.float64)
+        for name in FullSimulationConfig.model_fields
+        if not name.startswith("delta_")
+    }
+    outputs = [name for name in MEASURED_OUTPUTS if name in measurements_df.columns]
+    measured = np.concatenate([measurements_df[name].to_numpy(dtype=np.float64) for name in outputs])
+    used = np.isfinite(measured)
+    measured = measured[used]
+    columns = [FIELD_NAMES.index(name) for name in parameter_names]
+
+    def residuals(theta: np.ndarray, with_jacobian: bool = False):
+        experiment_setup = dict(inputs)
+        values = initial + scale * theta
+        for idx, name in enumerate(parameter_names):
+            experiment_setup[name] = np.full_like(inputs[name], values[idx])
+
+        if not with_jacobian:
+            simulated = simulate_batch(experiment_setup)
+            return np.concatenate([simulated[name] for name in outputs])[used] - measured
+
+        simulated = simulate_with_gradients(experiment_setup)
+        r = np.concatenate([simulated[name] for name in outputs])[used] - measured
+        # Derivatives with respect to the values, scaled to the relative parameters
+        jacobian = np.concatenate([simulated[f"d_{name}"][:, columns] for name in outputs])[used] * scale
+        return r, jacobian
+
+    return residuals
+
+
+def calibrate_unit(
+        measurements_df: pd.DataFrame,
+        parameter_names: list[str],
+        unit: str = "default",
+        max_iterations: int = 100,
+        tolerance: float = 1e-10
+) -> CalibrationResult:
+    """
+    Fits the chosen constants to the measured shots of one unit with Levenberg-Marquardt nonlinear least squares.
+    Residuals of all shots and their exact Jacobian are computed in a single vectorized model call per iteration.
+    Initial values are taken from the measurements, the fitted columns have to be constant within the unit.
+    Parameters are fitted relatively to their initial values, or absolutely if the initial value is 0.
+    :param measurements_df: pd.DataFrame, measured shots of one unit, see load_measurements
+    :param parameter_names: list[str], names of fitted parameters, from CALIBRATABLE_PARAMETERS
+    :param unit: str, unit identifier
+    :param max_iterations: int, maximum amount of iterations
+    :param tolerance: float, relative tolerance of parameters and cost
+    :return: result: CalibrationResult
+    """
+    unknown_parameters = set(parameter_names) - set(CALIBRATABLE_PARAMETERS)
+    assert not unknown_parameters, f"Parameters {sorted(unknown_parameters)} can not be calibrated."
+
+    varying_parameters = [name for name in parameter_names if measurements_df[name].nunique(dropna=False) > 1]
+    assert not varying_parameters, f"Parameters {varying_parameters} should be constant within the unit {unit}."
+
+    initial = measurements_df[parameter_names].iloc[0].to_numpy(dtype=np.float64)
+    scale = np.where(initial != 0, initial, 1.0)
+    residuals = get_residuals_function(measurements_df, parameter_names, initial, scale)
+    parameters_count = len(parameter_names)
+
+    theta = np.zeros(parameters_count)
+    damping = 1e-3
+    converged = False
+    iteration = 0
+    r = residuals(theta)
+    cost = r @ r
+    assert np.isfinite(cost), "Some measured shots are impossible with the initial parameters."
+
+    for iteration in range(1, max_iterations + 1):
+        _, jacobian = residuals(theta, with_jacobian=True)
+        if not np.all(np.isfinite(jacobian)):
+            break
+
+        hessian = jacobian.T @ jacobian
+        gradient = jacobian.T @ r
+
+        improved = False
+        while damping < 1e12:
+            damped = hessian + damping * np.diag(np.maximum(np.diag(hessian), 1e-12))
+            step = np.linalg.solve(damped, -gradient)
+            r_new = residuals(theta + step)
+            cost_new = r_new @ r_new
+            if np.isfinite(cost_new) and cost_new < cost:
+                improved = True
+                break
+            damping *= 10
+
+        if not improved:
+            # No step lowers the cost anymore, which is a minimum only if the gradient vanishes
+            converged = bool(
+                np.linalg.norm(gradient) <= np.sqrt(tolerance) * np.linalg.norm(jacobian) * np.sqrt(cost)
+            )
+            break
+
+        small_step = np.linalg.norm(step) <= tolerance * (np.linalg.norm(theta) + tolerance)
+        small_decrease = cost - cost_new <= tolerance * cost
+        theta, r, cost = theta + step, r_new, cost_new
+        damping = max(damping / 10, 1e-12)
+        if small_step or small_decrease:
+            converged = True
+            break
+
+    values = initial + scale * theta
+    degrees_of_freedom = max(r.size - parameters_count, 1)
+    _, jacobian = residuals(theta, with_jacobian=True)
+    jacobian = jacobian / scale
+    try:
+        covariance = np.linalg.inv(jacobian.T @ jacobian) * cost / degrees_of_freedom
+        standard_errors = dict(zip(parameter_names, np.sqrt(np.abs(np.diag(covariance))).tolist()))
+    except np.linalg.LinAlgError:
+        standard_errors = {name: float("nan") for name in parameter_names}
+
+    return CalibrationResult(
+        unit=unit,
+        parameters=dict(zip(parameter_names, values.tolist())),
+        initial_parameters=dict(zip(parameter_names, initial.tolist())),
+        residual_rms=float(np.sqrt(cost / r.size)),
+        iterations=iteration,
+        converged=converged,
+        standard_errors=standard_errors
+    )
+
+
+def _calibrate_unit_task(args: tuple) -> CalibrationResult:
+    unit, unit_df, parameter_names, max_iterations = args
+    return calibrate_unit(unit_df, parameter_names, unit=unit, max_iterations=max_iterations)
+
+
+def calibrate_units(
+        measurements_df: pd.DataFrame,
+        parameter_names: list[str],
+        unit_column: str = "unit",
+        processes: Optional[int] = None,
+        max_iterations: int = 100
+) -> dict[str, CalibrationResult]:
+    """
+    Fits every unit independently, units are distributed over a process pool
+    :param measurements_df: pd.DataFrame, measured shots of all units, see load_measurements
+    :param parameter_names: list[str], names of fitted parameters
+    :param unit_column: str, column with the unit identifier, all shots belong to one unit if it is absent
+    :param processes: Optional[int], amount of worker processes, one per unit up to cpu count by default
+    :param max_iterations: int, maximum amount of iterations per unit
+    :return: results: dict[str, CalibrationResult], by unit
+    """
+    if unit_column in measurements_df.columns:
+        tasks = [
+            (str(unit), unit_df.reset_index(drop=True), list(parameter_names), max_iterations)
+            for unit, unit_df in measurements_df.groupby(unit_column, sort=True)
+        ]
+    else:
+        tasks = [("default", measurements_df, list(parameter_names), max_iterations)]
+
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    if processes <= 1:
+        results = [_calibrate_unit_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes=processes) as pool:
+            results = pool.map(_calibrate_unit_task, tasks)
+
+    return {result.unit: result for result in results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--measurements", required=True, help="provide file path to measured shots csv")
+    parser.add_argument(
+        "--parameters",
+        nargs="+",
+        default=["spring_constant", "moment_of_inertia", "bungee_length_no_load"],
+        choices=CALIBRATABLE_PARAMETERS,
+        help="parameters to be fitted"
+    )
+    parser.add_argument("--unit-column", default="unit", help="column with the unit identifier")
+    parser.add_argument("--processes", type=int, default=None, help="amount of worker processes")
+    parser.add_argument("--output", default=None, help="provide file path to write fitted parameters csv")
+    args = parser.parse_args()
+
+    calibration_results = calibrate_units(
+        load_measurements(args.measurements),
+        parameter_names=args.parameters,
+        unit_column=args.unit_column,
+        processes=args.processes
+    )
+
+    rows = []
+    for calibration_result in calibration_results.values():
+        rows.append({
+            "unit": calibration_result.unit,
+            **calibration_result.parameters,
+            **{f"{k}_std_error": v for k, v in calibration_result.standard_errors.items()},
+            "residual_rms": calibration_result.residual_rms,
+            "iterations": calibration_result.iterations,
+            "converged": calibration_result.converged
+        })
+
+    results_df = pd.DataFrame(rows).set_index("unit")
+    print(results_df.to_string())
+    if args.output is not None:
+        results_df.to_csv(args.output)
@@ -2,6 +2,7 @@ from app.catapult_shot import calculate_bungee_diff_squares, calculate_omega, ge
     calculate_mass_starting_angle, get_speed_components, calculate_time_to_ground, calculate_max_height
 
 import math
+import numpy as np
 
 
 def simulate(experiment_setup: dict) -> dict:
@@ -79,3 +80,77 @@ def simulate(experiment_setup: dict) -> dict:
     }
 
     return outputs_dict
+
+
+def simulate_batch(experiment_setup: dict) -> dict:
+    """
+    Vectorized counterpart of simulate: every value of 'experiment_setup' may be a scalar or an array,
+    arrays are broadcast against each other and outputs are arrays of the broadcast shape.
+    Shots for which simulate raises an error (bungee without tension, mass starting under the ground, etc.)
+    get NaN outputs instead.
+    :param experiment_setup: dict, same keys as for simulate
+    :return: outputs_dict: dict, np.ndarray for every output
+    """
+    g = np.asarray(experiment_setup['g'], dtype=np.float64)
+    D = np.asarray(experiment_setup['spring_constant'], dtype=np.float64)
+    J = np.asarray(experiment_setup['moment_of_inertia'], dtype=np.float64)
+    m = np.asarray(experiment_setup['cup_mass'], dtype=np.float64) + experiment_setup['ball_mass']
+
+    axle_distance = np.asarray(experiment_setup['axle_distance'], dtype=np.float64)
+    bungee_length_no_load = np.asarray(experiment_setup['bungee_length_no_load'], dtype=np.float64)
+    height_offset = np.asarray(experiment_setup['height_offset'], dtype=np.float64)
+
+    pin_elevation = np.asarray(experiment_setup['pin_elevation'], dtype=np.float64)
+    bungee_position = np.asarray(experiment_setup['bungee_position'], dtype=np.float64)
+    cup_elevation = np.asarray(experiment_setup['cup_elevation'], dtype=np.float64)
+    firing_angle = np.radians(experiment_setup['firing_angle'])                     # in degrees
+    release_angle = np.radians(experiment_setup['release_angle'])                   # in degrees
+
+    lateral_deviation_angle = np.radians(experiment_setup['lateral_deviation_angle'])   # in degrees
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Bungee elongation at release and firing, see calculate_bungee_diff_squares
+        pin_length = np.abs(pin_elevation)
+        length_release = np.hypot(
+            axle_distance - np.cos(release_angle) * bungee_position,
+            pin_elevation - np.sin(release_angle) * bungee_position
+        ) + pin_length
+        length_firing = np.hypot(
+            axle_distance - np.cos(firing_angle) * bungee_position,
+            pin_elevation - np.sin(firing_angle) * bungee_position
+        ) + pin_length
+        s_release = (length_release > bungee_length_no_load) * (length_release - bungee_length_no_load)
+        s_firing = (length_firing > bungee_length_no_load) * (length_firing - bungee_length_no_load)
+        diff_s_squares = s_release ** 2 - s_firing ** 2
+
+        # See calculate_omega
+        omega = np.sqrt(D * diff_s_squares / (m * cup_elevation ** 2 + J))
+
+        velocity_start = omega * cup_elevation
+        x_start = - axle_distance + np.cos(firing_angle) * cup_elevation
+        y_start = np.sin(firing_angle) * cup_elevation + height_offset
+
+        angle_start = firing_angle - np.pi / 2
+        speed_x_start = velocity_start * np.cos(angle_start) * np.cos(lateral_deviation_angle)
+        speed_y_start = velocity_start * np.sin(angle_start)
+        speed_z_start = speed_x_start * np.sin(lateral_deviation_angle)
+
+        # See calculate_time_to_ground
+        discriminant = speed_y_start ** 2 + 2 * y_start * g
+        time_ground = 1 / -g * (-speed_y_start - np.sqrt(discriminant))
+        time_other = 1 / -g * (-speed_y_start + np.sqrt(discriminant))
+        valid = (discriminant >= 0) & ((time_other < 0) | (time_ground < 0)) & np.isfinite(omega)
+
+        x_coordinate_ground = np.where(valid, x_start + speed_x_start * time_ground, np.nan)
+        y_coordinate_ground = np.where(valid, 0.0, np.nan)
+        z_coordinate_ground = np.where(valid, speed_z_start * time_ground, np.nan)
+        max_height = np.where(valid, y_start + 1/2 * (speed_y_start ** 2) / g, np.nan)
+
+    outputs_dict = {
+        "x_ground": x_coordinate_ground,
+        "y_ground": y_coordinate_ground,
+        "z_ground": z_coordinate_ground,
+        "max_height": max_height
+    }
+
+    return outputs_dict
@@ -0,0 +1,245 @@
+from typing import Optional
+
+import math
+import numpy as np
+
+from app.configured_shot import simulate_batch
+from app.sampling import DEFAULT_SEED, apply_relative_deltas, sample_relative_deltas
+
+
+class LandingHistogram:
+    """
+    Fixed-memory summary of points of impact (x_ground, z_ground).
+
+    Impacts are streamed in chunks: they are binned into a 2D histogram over a fixed grid
+    and folded into running mean and covariance, so memory does not depend on the amount of shots.
+    Impacts outside of the grid are still counted in the moments and in 'outside'.
+    """
+
+    def __init__(
+            self,
+            x_range: tuple[float, float],
+            z_range: tuple[float, float],
+            bins: tuple[int, int] = (200, 200)
+    ):
+        self.x_edges = np.linspace(x_range[0], x_range[1], bins[0] + 1)
+        self.z_edges = np.linspace(z_range[0], z_range[1], bins[1] + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+        self.count = 0                  # Amount of valid impacts
+        self.failed = 0                 # Amount of shots without a point of impact (NaN outputs)
+        self.outside = 0                # Amount of impacts outside of the grid
+        self.mean = np.zeros(2)         # (x, z)
+        self.m2 = np.zeros((2, 2))      # Sum of outer products of deviations from the mean
+
+    def update(self, x_ground: np.ndarray, z_ground: np.ndarray) -> None:
+        """
+        Adds a chunk of impacts
+        :param x_ground: np.ndarray, in m
+        :param z_ground: np.ndarray, in m
+        :return: None
+        """
+        x_ground = np.ravel(x_ground)
+        z_ground = np.ravel(z_ground)
+        valid = np.isfinite(x_ground) & np.isfinite(z_ground)
+        self.failed += int(valid.size - np.count_nonzero(valid))
+
+        points = np.stack([x_ground[valid], z_ground[valid]], axis=1)
+        if points.shape[0] == 0:
+            return
+
+        chunk_counts, _, _ = np.histogram2d(points[:, 0], points[:, 1], bins=(self.x_edges, self.z_edges))
+        chunk_counts = chunk_counts.astype(np.int64)
+        self.counts += chunk_counts
+        self.outside += int(points.shape[0] - chunk_counts.sum())
+
+        chunk_mean = points.mean(axis=0)
+        deviations = points - chunk_mean
+        self._merge_moments(points.shape[0], chunk_mean, deviations.T @ deviations)
+
+    def _merge_moments(self, count: int, mean: np.ndarray, m2: np.ndarray) -> None:
+        # Pairwise update of mean and co-moments (Chan et al.), stable for any amount of chunks
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + np.outer(delta, delta) * self.count * count / total
+        self.count = total
+
+    def merge(self, other: "LandingHistogram") -> None:
+        """
+        Adds impacts summarized by another histogram with the same grid, e.g. computed by another process
+        :param other: LandingHistogram
+        :return: None
+        """
+        assert np.array_equal(self.x_edges, other.x_edges) and np.array_equal(self.z_edges, other.z_edges), \
+            "Make sure the histograms have the same grid."
+        self.counts += other.counts
+        self.failed += other.failed
+        self.outside += other.outside
+        if other.count > 0:
+            self._merge_moments(other.count, other.mean, other.m2)
+
+    @property
+    def covariance(self) -> np.ndarray:
+        """
+        Sample covariance of (x, z), in m^2
+        """
+        if self.count < 2:
+            return np.full((2, 2), np.nan)
+        return self.m2 / (self.count - 1)
+
+    def confidence_ellipse(self, level: float = 0.95) -> dict:
+        """
+        Returns the ellipse containing 'level' share of impacts under normal approximation
+        :param level: float, probability in (0, 1)
+        :return: ellipse: dict, center (x, z) in m, semi-axes (major, minor) in m, angle of major axis to x in degrees
+        """
+        assert 0 < level < 1, "Confidence level should be between 0 and 1."
+        # Quantile of chi-squared distribution with 2 degrees of freedom
+        scale = -2 * math.log(1 - level)
+        eigenvalues, eigenvectors = np.linalg.eigh(self.covariance)
+        major_vector = eigenvectors[:, 1]
+        # Sign of the eigenvector is arbitrary, the axis is reported within (-90, 90]
+        angle = math.degrees(math.atan2(major_vector[1], major_vector[0]))
+        if angle > 90:
+            angle -= 180
+        elif angle <= -90:
+            angle += 180
+
+        return {
+            "center": (float(self.mean[0]), float(self.mean[1])),
+            "semi_axes": (
+                math.sqrt(scale * max(eigenvalues[1], 0.0)),
+                math.sqrt(scale * max(eigenvalues[0], 0.0))
+            ),
+            "angle": angle
+        }
+
+    def density(self, bandwidth: Optional[tuple[float, float]] = None) -> np.ndarray:
+        """
+        Returns kernel density estimate on the grid of the histogram (binned Gaussian KDE)
+        :param bandwidth: Optional[tuple[float, float]], kernel standard deviations along x and z in m,
+            Scott's rule by default
+        :return: density: np.ndarray, in 1/m^2, integrates to the share of the smoothed impacts falling on the grid
+        """
+        density = self.counts.astype(np.float64)
+        if self.count == 0:
+            return density
+
+        if bandwidth is None:
+            # Spread is unknown for a single impact, it is left unsmoothed
+            if self.count < 2:
+                bandwidth = (0.0, 0.0)
+            else:
+                factor = self.count ** (-1 / 6)
+                bandwidth = tuple(np.sqrt(np.diag(self.covariance)) * factor)
+
+        for axis, (edges, sigma) in enumerate(zip((self.x_edges, self.z_edges), bandwidth)):
+            # No spread along the axis (e.g. lateral amplitude of 0), nothing to smooth
+            if not sigma > 0:
+                continue
+
+            bins = edges.shape[0] - 1
+            bin_width = edges[1] - edges[0]
+            half_width = max(int(math.ceil(4 * sigma / bin_width)), 1)
+            offsets = np.arange(-half_width, half_width + 1) * bin_width
+            kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+            kernel = kernel / kernel.sum()
+            # Kernel beyond the grid does not contribute to any cell of it, the mass it carries is lost off the grid
+            if half_width > bins - 1:
+                kernel = kernel[half_width - (bins - 1):half_width + bins]
+                half_width = bins - 1
+            density = np.apply_along_axis(
+                lambda line: np.convolve(line, kernel)[half_width:half_width + bins], axis, density
+            )
+
+        cell_area = (self.x_edges[1] - self.x_edges[0]) * (self.z_edges[1] - self.z_edges[0])
+        return density / (self.count * cell_area)
+
+
+class DispersionCollector:
+    """
+    Landing histograms per design point and per generation, all of them sharing the same grid
+    """
+
+    def __init__(
+            self,
+            x_range: tuple[float, float],
+            z_range: tuple[float, float],
+            bins: tuple[int, int] = (200, 200)
+    ):
+        self.x_range = x_range
+        self.z_range = z_range
+        self.bins = bins
+        self.histograms: dict[tuple[str, int, int], LandingHistogram] = {}
+
+    def get(self, design: str, generation: int, row: int) -> LandingHistogram:
+        key = (design, generation, row)
+        if key not in self.histograms:
+            self.histograms[key] = LandingHistogram(x_range=self.x_range, z_range=self.z_range, bins=self.bins)
+        return self.histograms[key]
+
+    def update(self, design: str, generation: int, row: int, outputs: dict) -> None:
+        """
+        Adds a chunk of outputs of configured_shot.simulate_batch for the design point 'row'
+        """
+        self.get(design, generation, row).update(outputs["x_ground"], outputs["z_ground"])
+
+    def combined(self, design: Optional[str] = None, generation: Optional[int] = None) -> LandingHistogram:
+        """
+        Returns the histogram over all design points matching the given design and / or generation
+        """
+        combined = LandingHistogram(x_range=self.x_range, z_range=self.z_range, bins=self.bins)
+        for (hist_design, hist_generation, _), histogram in self.histograms.items():
+            if design is not None and hist_design != design:
+                continue
+            if generation is not None and hist_generation != generation:
+                continue
+            combined.merge(histogram)
+        return combined
+
+
+def collect_dispersion(
+        collector: DispersionCollector,
+        input_dict: dict,
+        deltas_dict: dict,
+        design: str,
+        generation: int,
+        row: int,
+        shots: int,
+        chunk_size: int = 1_000_000,
+        seed: int = DEFAULT_SEED
+) -> LandingHistogram:
+    """
+    Simulates 'shots' replicates of a single design point with random deltas and streams the impacts into the collector.
+    Only one chunk of shots is kept in memory at a time.
+    Replicates are sampled with sampling.sample_relative_deltas, with the replicate index as row,
+    so any chunk can be recomputed on its own
+    :param collector: DispersionCollector
+    :param input_dict: dict, core inputs of the design point (angles as in the design)
+    :param deltas_dict: dict, amplitudes of the deltas, as on the 'deltas_for_design' sheet
+    :param design: str, design identifier
+    :param generation: int, generation index
+    :param row: int, position of the design point in the design
+    :param shots: int, amount of replicates
+    :param chunk_size: int, amount of replicates simulated at once
+    :param seed: int, global seed of the run
+    :return: histogram: LandingHistogram, of the design point
+    """
+    delta_names = list(deltas_dict.keys())
+    amplitudes = np.array(list(deltas_dict.values()), dtype=np.float64)
+
+    for shot_start in range(0, shots, chunk_size):
+        shot_stop = min(shot_start + chunk_size, shots)
+        relative_deltas = sample_relative_deltas(
+            amplitudes=amplitudes,
+            design=f"{design}/row_{row}",
+            generation=generation,
+            row_start=shot_start,
+            row_stop=shot_stop,
+            seed=seed
+        )
+        experiment_setup = apply_relative_deltas(input_dict, delta_names, relative_deltas)
+        collector.update(design, generation, row, simulate_batch(experiment_setup))
+
+    return collector.get(design, generation, row)
@@ -0,0 +1,94 @@
+from typing import Any, Callable, Optional
+
+import queue
+import threading
+
+
+# Marker telling the writer thread there will be no more jobs
+_STOP = object()
+
+
+class BackgroundWriter:
+    """
+    Runs blocking output jobs (e.g. DataFrame.to_excel / to_csv) in a background thread,
+    so the next generation can be computed while the previous one is being written.
+
+    The queue of pending jobs is bounded: 'submit' blocks while 'max_pending' jobs are waiting,
+    which keeps the amount of frames held in memory bounded.
+    If a job fails, the remaining jobs are still written, and the first error is raised
+    from the next 'submit' call or from 'close'.
+    """
+
+    def __init__(self, max_pending: int = 4):
+        assert max_pending > 0, "Make sure the writer can hold at least one pending job."
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is _STOP:
+                    return
+
+                func, args, kwargs = job
+                try:
+                    func(*args, **kwargs)
+                except BaseException as e:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> None:
+        """
+        Queues a job, blocks while the queue is full
+        :param func: Callable[..., Any], writing function, e.g. df.to_csv
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: None
+        """
+        assert not self._closed, "Writer is already closed."
+        self._raise_error()
+        self._jobs.put((func, args, kwargs))
+
+    def flush(self) -> None:
+        """
+        Waits until all the queued jobs are written
+        """
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """
+        Writes all the queued jobs and stops the thread
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        self._jobs.put(_STOP)
+        self._thread.join()
+        self._raise_error()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+            return
+
+        # Keep the original error, but do not lose the outputs which were already computed
+        try:
+            self.close()
+        except BaseException:
+            pass
@@ -0,0 +1,162 @@
+from typing import Optional
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import pandas as pd
+
+
+# Source files the simulated values depend on (including default constants of the models),
+# any change in them invalidates the cache
+MODEL_SOURCES = ("catapult_shot.py", "configured_shot.py", "models.py", "sampling.py", "simulate.py")
+
+# Name of the stored output df within a cache entry
+OUTPUT_DF_FILE_NAME = "output_df.pkl"
+
+# Errors of reading a stored output df which is truncated or was pickled by an incompatible pandas version
+UNPICKLING_ERRORS = (pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError, ValueError)
+
+
+def model_fingerprint() -> str:
+    """
+    Returns hash of the model source files, used as model version in the cache keys
+    :return: fingerprint: str, hex digest
+    """
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for source_name in MODEL_SOURCES:
+        with open(os.path.join(app_dir, source_name), "rb") as source_file:
+            digest.update(source_name.encode("utf-8"))
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def get_cache_key(
+        design: str,
+        input_df: pd.DataFrame,
+        deltas_dict: dict,
+        metadata_df: pd.DataFrame,
+        seed: int,
+        generation: int,
+        fingerprint: Optional[str] = None
+) -> str:
+    """
+    Returns content address of a single generation of a design:
+    hash of (design rows, deltas, meta-data, seed, generation, model version)
+    :param design: str, design identifier
+    :param input_df: pd.DataFrame, design rows
+    :param deltas_dict: dict, amplitudes of the deltas
+    :param metadata_df: pd.DataFrame, meta-data written along with the outputs
+    :param seed: int, seed of the delta sampling
+    :param generation: int, generation index
+    :param fingerprint: Optional[str], model version, model_fingerprint() by default
+    :return: key: str, hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update((fingerprint or model_fingerprint()).encode("utf-8"))
+    digest.update(json.dumps([design, seed, generation], default=str).encode("utf-8"))
+    digest.update(input_df.to_csv().encode("utf-8"))
+    digest.update(json.dumps(deltas_dict, sort_keys=True, default=repr).encode("utf-8"))
+    digest.update(metadata_df.to_csv().encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of generation outputs addressed by get_cache_key.
+    Every entry is a directory with the written output files and the output df used for stacking.
+    Least recently used entries are evicted once the cache is larger than 'max_bytes'.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key: str, output_paths: dict[str, str]) -> Optional[pd.DataFrame]:
+        """
+        Copies the cached files of an entry to the output paths
+        :param key: str, cache key
+        :param output_paths: dict[str, str], output path by kind of output, e.g. {"xlsx": ..., "csv": ...}
+        :return: output_df: Optional[pd.DataFrame], None on a miss
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            output_df = pd.read_pickle(os.path.join(entry_dir, OUTPUT_DF_FILE_NAME))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except UNPICKLING_ERRORS:
+            # Unreadable entry counts as a miss and is replaced by the next store
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        try:
+            for kind, output_path in output_paths.items():
+                shutil.copyfile(os.path.join(entry_dir, kind), output_path)
+            # Mark as recently used
+            os.utime(entry_dir)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        return output_df
+
+    def store(self, key: str, output_paths: dict[str, str], output_df: pd.DataFrame) -> None:
+        """
+        Adds written outputs to the cache, then evicts least recently used entries if the cache is too large
+        :param key: str, cache key
+        :param output_paths: dict[str, str], path of the written output by kind of output
+        :param output_df: pd.DataFrame, output df going to the stacked data
+        :return: None
+        """
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # Entry is built aside and renamed, so a killed run never leaves a partial entry
+        temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            for kind, output_path in output_paths.items():
+                shutil.copyfile(output_path, os.path.join(temp_dir, kind))
+            output_df.to_pickle(os.path.join(temp_dir, OUTPUT_DF_FILE_NAME))
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            # Another run stored the same entry meanwhile
+            if os.path.isdir(entry_dir):
+                return
+            raise
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Removes least recently used entries until the cache fits into 'max_bytes'
+        :param keep: Optional[str], key of the entry which should not be removed
+        :return: None
+        """
+        entries = []
+        total_bytes = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            entry_bytes = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            entries.append((os.stat(entry_dir).st_mtime, key, entry_bytes))
+            total_bytes += entry_bytes
+
+        for _, key, entry_bytes in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_bytes -= entry_bytes
@@ -0,0 +1,189 @@
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Optional
+
+import math
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from app.configured_shot import simulate
+
+
+OUTPUT_COLUMNS = ("x_ground", "y_ground", "z_ground", "max_height")
+
+
+@dataclass(frozen=True)
+class StoreHandle:
+    """
+    Picklable description of a result store, which is sent to the workers instead of the data itself
+    """
+    rows: int
+    columns: tuple[str, ...]
+    shm_name: Optional[str] = None      # Name of the shared memory block
+    path: Optional[str] = None          # Path of the memory-mapped file
+
+
+class ResultStore:
+    """
+    Float64 table of shape (rows, columns) living in shared memory or in a memory-mapped file.
+    Workers attach to the same buffer and write their row ranges in place,
+    the parent reads it back as a DataFrame or an array without copying.
+    Rows that were not written (or failed) stay NaN.
+    """
+
+    def __init__(self, handle: StoreHandle, owner: bool):
+        self.handle = handle
+        self.owner = owner
+        self._shm = None
+
+        shape = (handle.rows, len(handle.columns))
+        if handle.path is not None and handle.rows * len(handle.columns) == 0:
+            # Empty files can not be memory-mapped, there is nothing to share anyway
+            if owner:
+                open(handle.path, "wb").close()
+            self._array = np.empty(shape, dtype=np.float64)
+        elif handle.path is not None:
+            mode = "w+" if owner else "r+"
+            self._array = np.memmap(handle.path, dtype=np.float64, mode=mode, shape=shape)
+        else:
+            if owner:
+                size = max(handle.rows * len(handle.columns) * np.dtype(np.float64).itemsize, 1)
+                self._shm = shared_memory.SharedMemory(create=True, size=size)
+                self.handle = StoreHandle(rows=handle.rows, columns=handle.columns, shm_name=self._shm.name)
+            else:
+                self._shm = shared_memory.SharedMemory(name=handle.shm_name)
+            self._array = np.ndarray(shape, dtype=np.float64, buffer=self._shm.buf)
+
+        if owner:
+            self._array[:] = np.nan
+
+    @classmethod
+    def create(cls, rows: int, columns: tuple[str, ...] = OUTPUT_COLUMNS, path: Optional[str] = None) -> "ResultStore":
+        """
+        Allocates a new store, in shared memory by default or in the file 'path' if it is given
+        :param rows: int, amount of rows (shots)
+        :param columns: tuple[str, ...], output names
+        :param path: Optional[str], path of the memory-mapped file
+        :return: store: ResultStore
+        """
+        return cls(StoreHandle(rows=rows, columns=tuple(columns), path=path), owner=True)
+
+    @classmethod
+    def attach(cls, handle: StoreHandle) -> "ResultStore":
+        """
+        Attaches to a store created by another process
+        :param handle: StoreHandle, handle of the created store
+        :return: store: ResultStore
+        """
+        return cls(handle, owner=False)
+
+    def write_rows(self, row_start: int, values: np.ndarray) -> None:
+        """
+        Writes a block of results in place starting from the row 'row_start'
+        :param row_start: int, first row of the block
+        :param values: np.ndarray, shape (block_rows, columns)
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        row_stop = row_start + values.shape[0]
+        assert 0 <= row_start and row_stop <= self.handle.rows, "Row range is outside of the store."
+        self._array[row_start:row_stop] = values
+
+    def as_array(self) -> np.ndarray:
+        """
+        Returns the stored table as an array view, no data is copied
+        :return: array: np.ndarray, shape (rows, columns)
+        """
+        return self._array
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns the stored table as a DataFrame sharing the buffer of the store.
+        The store has to stay open as long as the DataFrame is used.
+        :return: df: pd.DataFrame
+        """
+        return pd.DataFrame(self._array, columns=list(self.handle.columns), copy=False)
+
+    def flush(self) -> None:
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+
+    def close(self) -> None:
+        """
+        Detaches from the buffer, the owner also releases the shared memory block.
+        Views obtained from the store must be dropped before.
+        """
+        self.flush()
+        self._array = None
+        if self._shm is not None:
+            self._shm.close()
+            if self.owner:
+                self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def simulate_into_store(handle: StoreHandle, experiment_setups: list[dict], row_start: int) -> int:
+    """
+    Worker function: simulates the given setups and writes the outputs into the store starting from 'row_start'
+    :param handle: StoreHandle, handle of the created store
+    :param experiment_setups: list[dict], inputs of configured_shot.simulate
+    :param row_start: int, row of the first setup in the store
+    :return: rows_written: int
+    """
+    values = np.full((len(experiment_setups), len(handle.columns)), np.nan)
+    for idx, experiment_setup in enumerate(experiment_setups):
+        # Leave erroring experiments empty (NaN), impossible shots fail either on math domain or on model assertions
+        try:
+            output_simulation = simulate(experiment_setup)
+        except (ValueError, AssertionError):
+            continue
+        values[idx] = [output_simulation[column] for column in handle.columns]
+
+    store = ResultStore.attach(handle)
+    try:
+        store.write_rows(row_start, values)
+    finally:
+        store.close()
+
+    return len(experiment_setups)
+
+
+def simulate_parallel(
+        experiment_setups: list[dict],
+        processes: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        path: Optional[str] = None
+) -> ResultStore:
+    """
+    Simulates all the setups in a process pool, each worker writes its row range directly into a shared store
+    :param experiment_setups: list[dict], inputs of configured_shot.simulate
+    :param processes: Optional[int], amount of worker processes, cpu count by default
+    :param chunk_size: Optional[int], amount of rows per task
+    :param path: Optional[str], path of the memory-mapped file, shared memory is used if not given
+    :return: store: ResultStore, to be closed by the caller
+    """
+    store = ResultStore.create(rows=len(experiment_setups), path=path)
+    processes = processes or multiprocessing.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(math.ceil(len(experiment_setups) / (processes * 4)), 1)
+
+    tasks = [
+        (store.handle, experiment_setups[row_start:row_start + chunk_size], row_start)
+        for row_start in range(0, len(experiment_setups), chunk_size)
+    ]
+
+    try:
+        with multiprocessing.Pool(processes=processes) as pool:
+            pool.starmap(simulate_into_store, tasks)
+    except BaseException:
+        store.close()
+        raise
+
+    return store
@@ -0,0 +1,168 @@
+from typing import Iterable
+
+import hashlib
+import numpy as np
+
+
+# Default seed of the delta sampling, the same one the simulation used with the global numpy generator
+DEFAULT_SEED = 43
+
+# Amount of 64-bit words Philox produces per counter increment
+PHILOX_BLOCK_WORDS = 4
+
+
+def design_key(design: str) -> int:
+    """
+    This function maps a design identifier onto a stable integer,
+    which (unlike built-in hash) does not change between interpreter runs
+    :param design: str, design (experiment core) identifier, e.g. file name without extension
+    :return: key: int, 64-bit unsigned integer
+    """
+    digest = hashlib.sha256(design.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], byteorder="little")
+
+
+def get_row_stride(deltas_count: int) -> int:
+    """
+    This function returns amount of random words reserved for a single row.
+    Each row starts at a Philox counter boundary, so any row can be reached with a plain counter advance
+    :param deltas_count: int, amount of deltas drawn per row
+    :return: stride: int, amount of 64-bit words per row
+    """
+    blocks = -(-deltas_count // PHILOX_BLOCK_WORDS)
+    return max(blocks, 1) * PHILOX_BLOCK_WORDS
+
+
+def get_bit_generator(design: str, generation: int, seed: int = DEFAULT_SEED) -> np.random.Philox:
+    """
+    Returns counter-based bit generator keyed by (seed, design, generation) with the counter at row 0
+    :param design: str, design identifier
+    :param generation: int, generation index
+    :param seed: int, global seed of the run
+    :return: bit_generator: np.random.Philox
+    """
+    seed_sequence = np.random.SeedSequence([seed, design_key(design), generation])
+    key = seed_sequence.generate_state(2, dtype=np.uint64)
+    return np.random.Philox(key=key)
+
+
+def get_row_generator(
+        design: str,
+        generation: int,
+        row_start: int,
+        deltas_count: int,
+        seed: int = DEFAULT_SEED
+) -> np.random.Generator:
+    """
+    Returns a generator positioned at the first random word of the row 'row_start'
+    :param design: str, design identifier
+    :param generation: int, generation index
+    :param row_start: int, position of the row in the design (0-based)
+    :param deltas_count: int, amount of deltas drawn per row
+    :param seed: int, global seed of the run
+    :return: generator: np.random.Generator
+    """
+    bit_generator = get_bit_generator(design=design, generation=generation, seed=seed)
+    bit_generator.advance(row_start * get_row_stride(deltas_count) // PHILOX_BLOCK_WORDS)
+    return np.random.Generator(bit_generator)
+
+
+def sample_relative_deltas(
+        amplitudes: np.ndarray,
+        design: str,
+        generation: int,
+        row_start: int,
+        row_stop: int,
+        seed: int = DEFAULT_SEED
+) -> np.ndarray:
+    """
+    This function draws deltas uniformly from [-amplitude, amplitude] for the rows [row_start, row_stop) in one call.
+    The result only depends on (seed, design, generation, row), so blocks can be drawn in any order or in parallel
+    :param amplitudes: np.ndarray, shape (deltas_count,), maximum absolute deviation of every delta
+    :param design: str, design identifier
+    :param generation: int, generation index
+    :param row_start: int, first row of the block (0-based)
+    :param row_stop: int, row after the last row of the block
+    :param seed: int, global seed of the run
+    :return: deltas: np.ndarray, shape (row_stop - row_start, deltas_count)
+    """
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    assert amplitudes.ndim == 1, "Amplitudes should be a flat array with one value per delta."
+    assert 0 <= row_start <= row_stop, "Make sure the block of rows is not reversed."
+
+    deltas_count = amplitudes.shape[0]
+    stride = get_row_stride(deltas_count)
+    generator = get_row_generator(
+        design=design,
+        generation=generation,
+        row_start=row_start,
+        deltas_count=deltas_count,
+        seed=seed
+    )
+
+    uniforms = generator.random((row_stop - row_start, stride))[:, :deltas_count]
+    return -amplitudes + 2 * amplitudes * uniforms
+
+
+def resample_rows(
+        amplitudes: np.ndarray,
+        design: str,
+        generation: int,
+        rows: Iterable[int],
+        seed: int = DEFAULT_SEED
+) -> np.ndarray:
+    """
+    This function regenerates deltas of an arbitrary subset of rows, e.g. to re-run a single failed row.
+    The values are exactly the same as the respective rows of a block drawn with sample_relative_deltas
+    :param amplitudes: np.ndarray, shape (deltas_count,)
+    :param design: str, design identifier
+    :param generation: int, generation index
+    :param rows: Iterable[int], positions of the rows in the design (0-based)
+    :param seed: int, global seed of the run
+    :return: deltas: np.ndarray, shape (len(rows), deltas_count)
+    """
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    deltas = [
+        sample_relative_deltas(
+            amplitudes=amplitudes,
+            design=design,
+            generation=generation,
+            row_start=row,
+            row_stop=row + 1,
+            seed=seed
+        )
+        for row in rows
+    ]
+
+    if not deltas:
+        return np.empty((0, amplitudes.shape[0]), dtype=np.float64)
+
+    return np.concatenate(deltas, axis=0)
+
+
+def apply_relative_deltas(input_dict: dict, delta_names: list[str], relative_deltas: np.ndarray) -> dict:
+    """
+    This function applies sampled deltas to the core inputs the same way simulate.py does for a single row,
+    and adjusts firing and release angles to the direction of angle calculation of the model.
+    Values of 'input_dict' may be scalars or arrays broadcastable to the amount of sampled rows,
+    a single row of deltas gives scalar inputs for configured_shot.simulate
+    :param input_dict: dict, core inputs of configured_shot.simulate (angles as in the design)
+    :param delta_names: list[str], names of the deltas, e.g. 'delta_g' or 'lateral_deviation_angle'
+    :param relative_deltas: np.ndarray, shape (rows, len(delta_names)) or (len(delta_names),)
+    :return: experiment_setup: dict, inputs of configured_shot.simulate_batch
+    """
+    experiment_setup = dict(input_dict)
+    for delta_idx, k_delta in enumerate(delta_names):
+        relative_delta = relative_deltas[..., delta_idx]
+        if k_delta != "lateral_deviation_angle":
+            k_core = k_delta[6:]
+            experiment_setup[k_core] = experiment_setup[k_core] + experiment_setup[k_core] * relative_delta
+        else:
+            experiment_setup[k_delta] = relative_delta
+
+    # Adjust firing and release angles
+    # due to difference of starting point and direction of angle calculation
+    experiment_setup['release_angle'] = 180 - np.asarray(experiment_setup['release_angle'])
+    experiment_setup['firing_angle'] = 180 - np.asarray(experiment_setup['firing_angle'])
+
+    return experiment_setup
@@ -0,0 +1,358 @@
+from collections import deque
+from typing import Optional
+
+import argparse
+import asyncio
+import json
+import math
+import time
+import numpy as np
+from pydantic import ValidationError
+
+from app.configured_shot import simulate_batch
+from app.models import FullSimulationConfig
+
+
+OUTPUT_NAMES = ("x_ground", "y_ground", "z_ground", "max_height")
+
+# Core inputs of the model, deltas of FullSimulationConfig are added to them as absolute values
+CORE_NAMES = tuple(name for name in FullSimulationConfig.model_fields if not name.startswith("delta_"))
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+# Amount of latest requests the latency percentiles are computed over
+LATENCY_WINDOW = 10_000
+
+
+class ServiceMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.shots = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def snapshot(self) -> dict:
+        uptime = time.perf_counter() - self.started
+        latencies_ms = np.array(self.latencies) * 1000
+        percentiles = {}
+        if latencies_ms.size > 0:
+            for percentile in (50, 90, 99):
+                percentiles[f"latency_p{percentile}_ms"] = float(np.percentile(latencies_ms, percentile))
+
+        return {
+            "uptime_s": uptime,
+            "requests": self.requests,
+            "shots": self.shots,
+            "batches": self.batches,
+            "errors": self.errors,
+            "mean_batch_shots": self.shots / self.batches if self.batches else 0.0,
+            "requests_per_s": self.requests / uptime,
+            "shots_per_s": self.shots / uptime,
+            **percentiles
+        }
+
+
+def parse_shots(payload) -> tuple[list[dict], bool]:
+    """
+    Validates a request body: a single shot or a batch of shots in the FullSimulationConfig JSON shape
+    :param payload: parsed JSON, an object, a list of objects or {"shots": [objects]}
+    :return: (shots, is_batch): tuple[list[dict], bool], validated inputs with defaults filled in
+    """
+    is_batch = isinstance(payload, list) or (isinstance(payload, dict) and "shots" in payload)
+    items = payload["shots"] if isinstance(payload, dict) and is_batch else payload
+    if not is_batch:
+        items = [items]
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError("Expected a shot object, a list of shot objects or {\"shots\": [...]}.")
+
+    # Misspelled fields would otherwise silently fall back to the defaults
+    for item in items:
+        unknown_fields = set(item) - set(FullSimulationConfig.model_fields)
+        if unknown_fields:
+            raise ValueError(f"Unknown fields: {sorted(unknown_fields)}.")
+
+    return [FullSimulationConfig(**item).model_dump() for item in items], is_batch
+
+
+def simulate_shots(shots: list[dict]) -> dict:
+    """
+    Simulates validated shots on the vectorized path
+    :param shots: list[dict], FullSimulationConfig dumps
+    :return: outputs_dict: dict, np.ndarray for every output
+    """
+    experiment_setup = {}
+    for name in CORE_NAMES:
+        values = np.array([shot[name] for shot in shots], dtype=np.float64)
+        delta_name = f"delta_{name}"
+        if delta_name in FullSimulationConfig.model_fields:
+            values = values + np.array([shot[delta_name] for shot in shots], dtype=np.float64)
+        experiment_setup[name] = values
+
+    return simulate_batch(experiment_setup)
+
+
+class MicroBatcher:
+    """
+    Gathers shots of concurrent requests into one vectorized model call.
+    A batch is run as soon as 'max_batch_shots' shots are waiting or 'window' seconds after its first request.
+    """
+
+    def __init__(self, metrics: ServiceMetrics, window: float = 0.002, max_batch_shots: int = 65_536):
+        self.metrics = metrics
+        self.window = window
+        self.max_batch_shots = max_batch_shots
+        self._pending: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, shots: list[dict]) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        await self._pending.put((shots, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._pending.get()]
+            batch_shots = len(batch[0][0])
+            deadline = loop.time() + self.window
+
+            while batch_shots < self.max_batch_shots:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._pending.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                batch_shots += len(item[0])
+
+            all_shots = [shot for shots, _ in batch for shot in shots]
+            try:
+                # Model runs off the event loop, so connections keep being served meanwhile
+                outputs = await loop.run_in_executor(None, simulate_shots, all_shots)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.metrics.batches += 1
+            self.metrics.shots += len(all_shots)
+            start = 0
+            for shots, future in batch:
+                stop = start + len(shots)
+                if not future.done():
+                    future.set_result({name: outputs[name][start:stop] for name in OUTPUT_NAMES})
+                start = stop
+
+
+def to_json_outputs(outputs: dict, index: int) -> dict:
+    # Impossible shots are NaN in the model, null in JSON
+    return {
+        name: None if math.isnan(value) else value
+        for name, value in ((name, float(outputs[name][index])) for name in OUTPUT_NAMES)
+    }
+
+
+class SimulationService:
+    """
+    Resident HTTP/1.1 service of the shot model over TCP or a Unix socket.
+
+    POST /simulate  - body is a single shot or a batch of shots in the FullSimulationConfig JSON shape
+                      (angles as in configured_shot.simulate, deltas added as absolute values)
+    GET  /metrics   - request, shot and batch counters, throughput and latency percentiles
+    """
+
+    def __init__(self, window: float = 0.002, max_batch_shots: int = 65_536):
+        self.metrics = ServiceMetrics()
+        self.batcher = MicroBatcher(self.metrics, window=window, max_batch_shots=max_batch_shots)
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080, unix_path: Optional[str] = None) -> None:
+        self.batcher.start()
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def _handle_request(self, method: str, path: str, body: bytes) -> tuple[int, object]:
+        if path == "/metrics":
+            if method != "GET":
+                return 405, {"error": "Use GET."}
+            return 200, self.metrics.snapshot()
+
+        if path != "/simulate":
+            return 404, {"error": f"Unknown path '{path}'."}
+        if method != "POST":
+            return 405, {"error": "Use POST."}
+
+        started = time.perf_counter()
+        try:
+            shots, is_batch = parse_shots(json.loads(body))
+        except (ValueError, TypeError, ValidationError) as e:
+            return 400, {"error": str(e)}
+
+        outputs = await self.batcher.submit(shots)
+        self.metrics.requests += 1
+        self.metrics.latencies.append(time.perf_counter() - started)
+
+        if not is_batch:
+            return 200, to_json_outputs(outputs, 0)
+        return 200, {"results": [to_json_outputs(outputs, idx) for idx in range(len(shots))]}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, response = await self._handle_request(method, path, body)
+                except Exception as e:
+                    status, response = 500, {"error": repr(e)}
+
+                if status != 200:
+                    self.metrics.errors += 1
+                response_body = json.dumps(response).encode("utf-8")
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(response_body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + response_body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class ServiceClient:
+    """
+    Minimal keep-alive client of SimulationService, for local tools and tests.
+    Requests of concurrent tasks sharing a client are sent one after another, use several clients for concurrency.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080, unix_path: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # One request at a time goes over the connection
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> None:
+        if self.unix_path is not None:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method: str, path: str, payload=None) -> tuple[int, object]:
+        """
+        Sends a request over the kept-alive connection
+        :param method: str, "GET" or "POST"
+        :param path: str, e.g. "/simulate"
+        :param payload: JSON-serializable body
+        :return: (status, response): tuple[int, object]
+        """
+        async with self._lock:
+            return await self._request(method, path, payload)
+
+    async def _request(self, method: str, path: str, payload) -> tuple[int, object]:
+        if self._writer is None:
+            await self._connect()
+
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self._writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+        )
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split(b" ", 2)[1])
+        content_length = 0
+        while True:
+            header_line = await self._reader.readline()
+            if header_line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header_line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                content_length = int(value.strip())
+
+        return status, json.loads(await self._reader.readexactly(content_length))
+
+    async def simulate(self, shots) -> object:
+        """
+        Simulates a single shot (dict) or a batch of shots (list of dicts)
+        """
+        status, response = await self.request("POST", "/simulate", shots)
+        if status != 200:
+            raise RuntimeError(f"Simulation service responded with {status}: {response}")
+        return response if isinstance(shots, dict) else response["results"]
+
+    async def metrics(self) -> dict:
+        return (await self.request("GET", "/metrics"))[1]
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._reader, self._writer = None, None
+
+
+async def serve(host: str, port: int, unix_path: Optional[str], window: float, max_batch_shots: int) -> None:
+    service = SimulationService(window=window, max_batch_shots=max_batch_shots)
+    await service.start(host=host, port=port, unix_path=unix_path)
+    print(f"Simulation service is listening on {unix_path or f'http://{host}:{port}'}")
+    try:
+        await service.server.serve_forever()
+    finally:
+        await service.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--unix-socket", default=None, help="listen on a Unix socket at this path instead of TCP")
+    parser.add_argument("--window-ms", type=float, default=2.0, help="time to gather requests into a batch")
+    parser.add_argument("--max-batch-shots", type=int, default=65_536, help="maximum amount of shots in a batch")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.unix_socket, args.window_ms / 1000, args.max_batch_shots))
@@ -0,0 +1,231 @@
+import math
+import numpy as np
+
+from app.models import FullSimulationConfig
+
+
+# Inputs the derivatives are taken with respect to, in the order of the last axis of the Jacobians
+FIELD_NAMES = tuple(FullSimulationConfig.model_fields)
+
+# Core inputs of the model, deltas are added to them as absolute values (as in data/input.csv)
+CORE_NAMES = tuple(name for name in FIELD_NAMES if not name.startswith("delta_"))
+
+GRADIENT_OUTPUTS = ("x_ground", "z_ground", "max_height")
+
+
+class Dual:
+    """
+    Forward-mode dual number over a batch of shots:
+    'value' has shape (n,), 'grad' has shape (n, p) and holds partial derivatives with respect to p seeded inputs.
+    """
+
+    __array_priority__ = 100
+
+    def __init__(self, value: np.ndarray, grad: np.ndarray):
+        self.value = value
+        self.grad = grad
+
+    @staticmethod
+    def _unpack(other) -> tuple[np.ndarray, np.ndarray | float]:
+        if isinstance(other, Dual):
+            return other.value, other.grad
+        return np.asarray(other, dtype=np.float64), 0.0
+
+    def __add__(self, other) -> "Dual":
+        value, grad = self._unpack(other)
+        return Dual(self.value + value, self.grad + grad)
+
+    __radd__ = __add__
+
+    def __sub__(self, other) -> "Dual":
+        value, grad = self._unpack(other)
+        return Dual(self.value - value, self.grad - grad)
+
+    def __rsub__(self, other) -> "Dual":
+        value, grad = self._unpack(other)
+        return Dual(value - self.value, grad - self.grad)
+
+    def __neg__(self) -> "Dual":
+        return Dual(-self.value, -self.grad)
+
+    def __mul__(self, other) -> "Dual":
+        value, grad = self._unpack(other)
+        return Dual(
+            self.value * value,
+            self.grad * np.expand_dims(value, -1) + np.expand_dims(self.value, -1) * grad
+        )
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other) -> "Dual":
+        value, grad = self._unpack(other)
+        quotient = self.value / value
+        return Dual(
+            quotient,
+            (self.grad - np.expand_dims(quotient, -1) * grad) / np.expand_dims(value, -1)
+        )
+
+    def __rtruediv__(self, other) -> "Dual":
+        value, grad = self._unpack(other)
+        quotient = value / self.value
+        return Dual(
+            quotient,
+            (grad - np.expand_dims(quotient, -1) * self.grad) / np.expand_dims(self.value, -1)
+        )
+
+    def __pow__(self, power: int) -> "Dual":
+        return Dual(
+            self.value ** power,
+            np.expand_dims(power * self.value ** (power - 1), -1) * self.grad
+        )
+
+
+def dual_sqrt(x: Dual) -> Dual:
+    root = np.sqrt(x.value)
+    return Dual(root, x.grad / np.expand_dims(2 * root, -1))
+
+
+def dual_sin(x: Dual) -> Dual:
+    return Dual(np.sin(x.value), np.expand_dims(np.cos(x.value), -1) * x.grad)
+
+
+def dual_cos(x: Dual) -> Dual:
+    return Dual(np.cos(x.value), -np.expand_dims(np.sin(x.value), -1) * x.grad)
+
+
+def dual_where(condition: np.ndarray, x: Dual, y: float) -> Dual:
+    return Dual(np.where(condition, x.value, y), np.where(np.expand_dims(condition, -1), x.grad, 0.0))
+
+
+def calculate_bungee_diff_squares(
+        rest_length: Dual,
+        bungee_position: Dual,
+        pin_elevation: Dual,
+        axle_distance: Dual,
+        release_angle: Dual,
+        firing_angle: Dual
+) -> Dual:
+    """
+    Dual counterpart of catapult_shot.calculate_bungee_diff_squares, angles in radians
+    """
+    pin_length = dual_sqrt(pin_elevation ** 2)
+
+    length_release = dual_sqrt(
+        (axle_distance - dual_cos(release_angle) * bungee_position) ** 2
+        + (pin_elevation - dual_sin(release_angle) * bungee_position) ** 2
+    ) + pin_length
+    length_firing = dual_sqrt(
+        (axle_distance - dual_cos(firing_angle) * bungee_position) ** 2
+        + (pin_elevation - dual_sin(firing_angle) * bungee_position) ** 2
+    ) + pin_length
+
+    s_release = dual_where(length_release.value > rest_length.value, length_release - rest_length, 0.0)
+    s_firing = dual_where(length_firing.value > rest_length.value, length_firing - rest_length, 0.0)
+    return s_release ** 2 - s_firing ** 2
+
+
+def calculate_omega(
+        spring_constant: Dual,
+        difference_s_squares: Dual,
+        mass_payload: Dual,
+        mass_distance: Dual,
+        arm_moment_of_inertia: Dual
+) -> Dual:
+    """
+    Dual counterpart of catapult_shot.calculate_omega
+    """
+    return dual_sqrt(spring_constant * difference_s_squares / (mass_payload * mass_distance ** 2 + arm_moment_of_inertia))
+
+
+def calculate_time_to_ground(acceleration_y: Dual, speed_y_start: Dual, position_y_start: Dual) -> Dual:
+    """
+    Dual counterpart of catapult_shot.calculate_time_to_ground, NaN where there is no landing
+    """
+    discriminant = speed_y_start ** 2 - 2 * position_y_start * acceleration_y
+    return 1 / acceleration_y * (-speed_y_start - dual_sqrt(discriminant))
+
+
+def simulate_with_gradients(experiment_setup: dict) -> dict:
+    """
+    Simulates a batch of shots and returns x_ground, z_ground and max_height
+    together with their exact partial derivatives with respect to every FullSimulationConfig field.
+    Missing fields are taken from FullSimulationConfig defaults. Deltas are added to their core values
+    as absolute values, so the derivative with respect to a delta equals the one with respect to its core value.
+    Shots without a landing point get NaN values and derivatives.
+    :param experiment_setup: dict, scalars or arrays broadcastable to one shape, angles in degrees
+    :return: outputs_dict: dict, for every output its values (n,) and f"d_{output}" Jacobian (n, len(FIELD_NAMES))
+    """
+    defaults = FullSimulationConfig().model_dump()
+    values = np.broadcast_arrays(*[
+        np.atleast_1d(np.asarray(experiment_setup.get(name, defaults[name]), dtype=np.float64))
+        for name in FIELD_NAMES
+    ])
+    values = {name: value.ravel() for name, value in zip(FIELD_NAMES, values)}
+    shots = values[FIELD_NAMES[0]].shape[0]
+
+    # Seed core inputs, every one of them gets its own column of the Jacobian
+    inputs = {}
+    for idx, name in enumerate(CORE_NAMES):
+        grad = np.zeros((shots, len(CORE_NAMES)))
+        grad[:, idx] = 1.0
+        value = values[name] + values.get(f"delta_{name}", 0.0)
+        inputs[name] = Dual(value, grad)
+
+    degrees = math.pi / 180
+    g = inputs['g']
+    m = inputs['cup_mass'] + inputs['ball_mass']
+    firing_angle = inputs['firing_angle'] * degrees
+    release_angle = inputs['release_angle'] * degrees
+    lateral_deviation_angle = inputs['lateral_deviation_angle'] * degrees
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        diff_s_squares = calculate_bungee_diff_squares(
+            rest_length=inputs['bungee_length_no_load'],
+            bungee_position=inputs['bungee_position'],
+            pin_elevation=inputs['pin_elevation'],
+            axle_distance=inputs['axle_distance'],
+            release_angle=release_angle,
+            firing_angle=firing_angle
+        )
+
+        omega = calculate_omega(
+            spring_constant=inputs['spring_constant'],
+            difference_s_squares=diff_s_squares,
+            mass_payload=m,
+            mass_distance=inputs['cup_elevation'],
+            arm_moment_of_inertia=inputs['moment_of_inertia']
+        )
+
+        velocity_start = omega * inputs['cup_elevation']
+        x_start = dual_cos(firing_angle) * inputs['cup_elevation'] - inputs['axle_distance']
+        y_start = dual_sin(firing_angle) * inputs['cup_elevation'] + inputs['height_offset']
+
+        angle_start = firing_angle - math.pi / 2
+        speed_x_start = velocity_start * dual_cos(angle_start) * dual_cos(lateral_deviation_angle)
+        speed_y_start = velocity_start * dual_sin(angle_start)
+        speed_z_start = speed_x_start * dual_sin(lateral_deviation_angle)
+
+        time_ground = calculate_time_to_ground(
+            acceleration_y=-g,
+            speed_y_start=speed_y_start,
+            position_y_start=y_start
+        )
+
+        outputs = {
+            "x_ground": x_start + speed_x_start * time_ground,
+            "z_ground": speed_z_start * time_ground,
+            "max_height": y_start + 1/2 * speed_y_start ** 2 / g
+        }
+
+        # Same validity conditions as in configured_shot.simulate_batch
+        time_other = 1 / -g.value * (-speed_y_start.value + np.sqrt(speed_y_start.value ** 2 + 2 * y_start.value * g.value))
+        valid = np.isfinite(time_ground.value) & ((time_ground.value < 0) | (time_other < 0))
+
+    # Spread derivatives of core inputs onto all the fields: a delta acts as its core value
+    columns = [CORE_NAMES.index(name[6:] if name.startswith("delta_") else name) for name in FIELD_NAMES]
+    outputs_dict = {}
+    for name, output in outputs.items():
+        outputs_dict[name] = np.where(valid, output.value, np.nan)
+        outputs_dict[f"d_{name}"] = np.where(valid[:, None], output.grad[:, columns], np.nan)
+
+    return outputs_dict
@@ -0,0 +1,179 @@
+from typing import Callable, Optional
+
+import math
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Order of the values in the flat parameter tuple of the kernel
+PARAMETER_NAMES = (
+    "g",
+    "spring_constant",
+    "moment_of_inertia",
+    "cup_mass",
+    "ball_mass",
+    "axle_distance",
+    "bungee_length_no_load",
+    "height_offset",
+    "pin_elevation",
+    "bungee_position",
+    "cup_elevation",
+    "firing_angle",
+    "release_angle",
+    "lateral_deviation_angle",
+)
+
+OUTPUT_NAMES = ("x_ground", "y_ground", "z_ground", "max_height")
+
+BACKENDS = ("python", "numba")
+
+# Backend used by default, can be overridden with the CATAPULT_SHOT_BACKEND environment variable
+DEFAULT_BACKEND = os.environ.get("CATAPULT_SHOT_BACKEND", "numba" if numba is not None else "python")
+
+
+def shot_kernel_python(params) -> tuple[float, float, float, float]:
+    """
+    Scalar shot model over a flat parameter sequence, with the same equations as configured_shot.simulate,
+    but without dict lookups and intermediate function calls.
+    Instead of raising an error for an impossible shot, all the outputs are NaN.
+    :param params: sequence of floats in the order of PARAMETER_NAMES (angles in degrees)
+    :return: (x_ground, y_ground, z_ground, max_height): tuple[float, float, float, float], in m
+    """
+    g = params[0]
+    D = params[1]
+    J = params[2]
+    m = params[3] + params[4]
+    axle_distance = params[5]
+    bungee_length_no_load = params[6]
+    height_offset = params[7]
+    pin_elevation = params[8]
+    bungee_position = params[9]
+    cup_elevation = params[10]
+    firing_angle = math.radians(params[11])
+    release_angle = math.radians(params[12])
+    lateral_deviation_angle = math.radians(params[13])
+
+    # Bungee elongation at release and firing
+    pin_length = abs(pin_elevation)
+    length_release = math.sqrt(
+        (axle_distance - math.cos(release_angle) * bungee_position) ** 2
+        + (pin_elevation - math.sin(release_angle) * bungee_position) ** 2
+    ) + pin_length
+    length_firing = math.sqrt(
+        (axle_distance - math.cos(firing_angle) * bungee_position) ** 2
+        + (pin_elevation - math.sin(firing_angle) * bungee_position) ** 2
+    ) + pin_length
+    s_release = length_release - bungee_length_no_load if length_release > bungee_length_no_load else 0.0
+    s_firing = length_firing - bungee_length_no_load if length_firing > bungee_length_no_load else 0.0
+
+    omega_squared = D * (s_release ** 2 - s_firing ** 2) / (m * cup_elevation ** 2 + J)
+    if not omega_squared >= 0:
+        return math.nan, math.nan, math.nan, math.nan
+
+    velocity_start = math.sqrt(omega_squared) * cup_elevation
+    x_start = - axle_distance + math.cos(firing_angle) * cup_elevation
+    y_start = math.sin(firing_angle) * cup_elevation + height_offset
+
+    angle_start = firing_angle - math.pi / 2
+    speed_x_start = velocity_start * math.cos(angle_start) * math.cos(lateral_deviation_angle)
+    speed_y_start = velocity_start * math.sin(angle_start)
+    speed_z_start = speed_x_start * math.sin(lateral_deviation_angle)
+
+    discriminant = speed_y_start ** 2 + 2 * y_start * g
+    if not discriminant >= 0:
+        return math.nan, math.nan, math.nan, math.nan
+
+    time_ground = 1 / -g * (-speed_y_start - math.sqrt(discriminant))
+    time_other = 1 / -g * (-speed_y_start + math.sqrt(discriminant))
+    if not (time_ground < 0 or time_other < 0):
+        return math.nan, math.nan, math.nan, math.nan
+
+    x_ground = x_start + speed_x_start * time_ground
+    z_ground = speed_z_start * time_ground
+    max_height = y_start + 1/2 * (speed_y_start ** 2) / g
+    return x_ground, 0.0, z_ground, max_height
+
+
+if numba is not None:
+    shot_kernel_numba = numba.njit(cache=True)(shot_kernel_python)
+else:
+    shot_kernel_numba = None
+
+
+def get_kernel(backend: Optional[str] = None) -> Callable:
+    """
+    Returns the scalar kernel of the requested backend
+    :param backend: Optional[str], one of BACKENDS, DEFAULT_BACKEND if not given
+    :return: kernel: Callable, params -> (x_ground, y_ground, z_ground, max_height)
+    """
+    backend = backend or DEFAULT_BACKEND
+    assert backend in BACKENDS, f"Unknown backend '{backend}', choose one of {BACKENDS}."
+
+    if backend == "numba":
+        if shot_kernel_numba is None:
+            raise ImportError("Backend 'numba' requires numba to be installed.")
+        return shot_kernel_numba
+
+    return shot_kernel_python
+
+
+def to_parameters(experiment_setup: dict) -> np.ndarray:
+    """
+    Converts an input dict of configured_shot.simulate into the flat parameter array of the kernel
+    :param experiment_setup: dict, inputs of configured_shot.simulate
+    :return: params: np.ndarray, shape (len(PARAMETER_NAMES),)
+    """
+    return np.array([experiment_setup[name] for name in PARAMETER_NAMES], dtype=np.float64)
+
+
+def simulate(experiment_setup: dict, backend: Optional[str] = None) -> dict:
+    """
+    Drop-in replacement of configured_shot.simulate running on the scalar kernel
+    :param experiment_setup: dict, inputs of configured_shot.simulate
+    :param backend: Optional[str], one of BACKENDS
+    :return: outputs_dict: dict, NaN outputs for an impossible shot
+    """
+    outputs = get_kernel(backend)(to_parameters(experiment_setup))
+    return dict(zip(OUTPUT_NAMES, outputs))
+
+
+def validate_kernel(
+        backend: Optional[str] = None,
+        input_path: str = "../data/input.csv",
+        output_path: str = "../data/output.csv"
+) -> float:
+    """
+    Runs the kernel over the reference inputs and returns the largest absolute deviation from the reference outputs.
+    Deltas of the reference inputs are absolute and are added to the core values as they are.
+    :param backend: Optional[str], one of BACKENDS
+    :param input_path: str, path to the reference inputs
+    :param output_path: str, path to the reference outputs
+    :return: max_error: float, in m
+    """
+    kernel = get_kernel(backend)
+    input_df = pd.read_csv(input_path, index_col="Index", encoding="utf-8-sig")
+    output_df = pd.read_csv(output_path, index_col="Index")
+
+    parameters = input_df[list(PARAMETER_NAMES)].to_numpy(dtype=np.float64)
+    for idx, name in enumerate(PARAMETER_NAMES):
+        delta_name = f"delta_{name}"
+        if delta_name in input_df.columns:
+            parameters[:, idx] += input_df[delta_name].to_numpy(dtype=np.float64)
+
+    simulated = np.array([kernel(row) for row in parameters])
+    reference = output_df.loc[input_df.index, list(OUTPUT_NAMES)].to_numpy(dtype=np.float64)
+    return float(np.max(np.abs(simulated - reference)))
+
+
+if __name__ == "__main__":
+    for backend in BACKENDS:
+        if backend == "numba" and shot_kernel_numba is None:
+            print("numba: not installed, skipped")
+            continue
+        print(f"{backend}: max abs error against reference outputs = {validate_kernel(backend)}")
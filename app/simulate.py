@@ -6,7 +6,10 @@ import glob
 import datetime
 
 from app.configured_shot import simulate
-from models import FullSimulationConfig, SimulationConfig
+from app.output_writer import BackgroundWriter
+from app.result_cache import ResultCache, get_cache_key, model_fingerprint
+from app.sampling import DEFAULT_SEED, apply_relative_deltas, sample_relative_deltas
+from app.models import FullSimulationConfig, SimulationConfig
 
 
 def mm_to_m(millimeters: float) -> float:
@@ -39,6 +42,30 @@ RENAMING_MAP = {
 
 REVERSE_NAMING_MAP = {v: k for k, v in RENAMING_MAP.items()}
 
+
+def stack_outputs(stacked_data_df: pd.DataFrame | None, output_df: pd.DataFrame) -> pd.DataFrame:
+    if stacked_data_df is None:
+        return output_df.copy()
+    return pd.concat([stacked_data_df, output_df], ignore_index=True)
+
+
+def write_generation_outputs(
+        output_paths: dict[str, str],
+        output_df: pd.DataFrame,
+        extended_df: pd.DataFrame,
+        metadata_df: pd.DataFrame,
+        cache: ResultCache | None = None,
+        cache_key: str | None = None
+) -> None:
+    output_df.to_excel(output_paths["xlsx"])
+    extended_df.to_csv(output_paths["csv"])
+    metadata_df.to_csv(output_paths["metadata"])
+
+    # Cached only if all the outputs of the generation were written
+    if cache is not None:
+        cache.store(cache_key, output_paths, output_df)
+
+
 # Dict with amplitudes of deltas in percentages for maximum possible deviation
 # Change / Comment before run
 DELTAS = {
@@ -62,6 +89,9 @@ DELTAS = {
     "lateral_deviation_angle": 0.05 * 30  # degrees
 }
 
+# Share of the bungee stiffness left after every generation
+BUNGEE_WEAR_FACTOR = 0.9
+
 ALL_FACTORS = [
     'ball_mass',
     'firing_angle',
@@ -81,11 +111,16 @@ ALL_FACTORS = [
 # - Not to vary too much -> if finish with rect only then go to normal distribution
 # - Start with absolute value of the stiffness before looking at jitter
 if __name__ == "__main__":
-    # Set up seed for random generator
-    np.random.seed(43)
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-file", help="provide file path to input file")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="seed of the delta sampling")
+    parser.add_argument(
+        "--writer-queue-size", type=int, default=4, help="maximum amount of outputs waiting to be written"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="recompute all generations without using the cache")
+    parser.add_argument("--cache-dir", default="../data/simulations/cache", help="provide path to the cache directory")
+    parser.add_argument("--cache-size-mb", type=int, default=1024, help="maximum size of the cache in megabytes")
+    args = parser.parse_args()
 
     default_input_dir = "../data/simulations/raw"
     default_output_dir = "../data/simulations/generated"
@@ -100,150 +135,191 @@ if __name__ == "__main__":
     # Amount of total generations
     generations = 4
 
-    # Iterating over files
-    for input_file_name in filenames:
-        # Skip temporary excel files
-        if "~$" in input_file_name:
-            continue
-
-        input_path = os.path.join(default_input_dir, input_file_name)
-
-        input_df = pd.read_excel(input_path, header=0, converters=CONVERTING_MAP)
-        input_df = input_df.rename(mapper=RENAMING_MAP, axis="columns")
-
-        # Meta-data information df
-        metadata_df = pd.read_excel(input_path, sheet_name="Meta-data")
-
-        # Experiment identifier
-        experiment_core_identifier = input_file_name.split('.')[0]
-
-        # Deltas information df
-        deltas_information_df = pd.read_excel(input_path, sheet_name="deltas_for_design")
-
-        # Factors chosen in the design
-        design_input_columns = list(input_df.columns)
-        # List of all possible factors
-        input_columns = ALL_FACTORS
-        # Set of factors not chosen in the design
-        const_input_columns = set(input_columns) - set(design_input_columns)
-        for gen_idx in range(generations):
-
-            experiment_identifier = experiment_core_identifier + f"-generation_{gen_idx}"
-
-            # Insert file_name into meta-data df
-            metadata_df['Experiment Identifier'] = experiment_identifier
-
-            outputs_only = []
-            io_only = []
-            extended_ls = []
-
-            output_columns = None
-            for index, df_row in input_df.iterrows():
-                fl_model = FullSimulationConfig(**df_row.to_dict())
-
-                # Wear out (lower stiffness of) bungee rope
-                fl_model.spring_constant = fl_model.spring_constant * 0.9**gen_idx
-                print(experiments_count, "/", len(filenames))
-
-                # Necessary data for simulation
-                input_dict = {k: v for k, v in fl_model.model_dump().items() if 'delta' not in k}
-                deltas_dict = deltas_information_df.loc[0].to_dict()
-
-                # Data going to output files
-                chosen_deltas = {}
-                initial_inputs = input_dict.copy()
-                initial_inputs['Experiment Identifier'] = metadata_df.loc[0, 'Experiment Identifier']
-
-                for k_delta, v_delta in deltas_dict.items():
-                    relative_delta = np.random.uniform(-1 * v_delta, v_delta)
-
-                    chosen_deltas[f"{k_delta}_chosen"] = relative_delta
-
-                    k_core = k_delta[6:]
-                    if k_delta != "lateral_deviation_angle":
-                        input_dict[k_core] = input_dict[k_core] + input_dict[k_core] * relative_delta
-                    else:
-                        input_dict[k_delta] = relative_delta
-
-                # Adjust firing and release angles
-                # due to difference of starting point and direction of angle calculation
-                input_dict['release_angle'] = 180 - input_dict['release_angle']
-                input_dict['firing_angle'] = 180 - input_dict['firing_angle']
-
-                # Leave empty erroring experiments
-                try:
-                    output_simulation = simulate(input_dict)
-
-                except ValueError as e:
-                    output_simulation = {
-                        "x_ground": "",
-                        "y_ground": "",
-                        "z_ground": "",
-                        "max_height": ""
-                    }
-
-                # Set output columns names
-                if output_columns is None:
-                    output_columns = output_simulation.keys()
-
-                output_simulation['Index'] = index
-
-                io_data = {**output_simulation, **initial_inputs}
-                extended_data = {**io_data, **chosen_deltas}
-
-                outputs_only.append(output_simulation)
-                io_only.append(io_data)
-                extended_ls.append(extended_data)
-
-            assert output_columns is not None, "Column names for the outputs were not inferred"
-
-            # Output paths
-            default_output_file_name = f"output-{experiment_identifier}.xlsx"
-            default_output_path = os.path.join(default_output_dir, 'xlsx', default_output_file_name)
-
-            csv_output_file_name = f"output-{experiment_identifier}.csv"
-            csv_output_path = os.path.join(default_output_dir, 'csv', csv_output_file_name)
-
-            metadata_output_file_name = f"output-{experiment_identifier}.csv"
-            metadata_output_path = os.path.join(default_output_dir, 'metadata', metadata_output_file_name)
-
-            # Writing down data
-            output_df = pd.DataFrame(
-                io_only,
-                columns=[
-                    *input_columns,
-                    *output_columns,
-                    'Experiment Identifier',
-                ]
-            )
-            output_df.set_index('Index', inplace=True)
-            output_df = output_df.rename(REVERSE_NAMING_MAP, axis='columns')
-            output_df.to_excel(default_output_path)
-
-            # Stacking data in all runs data file
-            if stacked_data_df is None:
-                stacked_data_df = output_df.copy()
-            else:
-                stacked_data_df = pd.concat([stacked_data_df, output_df], ignore_index=True)
-
-            extended_df = pd.DataFrame(extended_ls)
-            extended_df.set_index('Index', inplace=True)
-            extended_df.to_csv(csv_output_path)
-
-            metadata_df.to_csv(metadata_output_path)
-
-            experiments_count += 1
-
-        # Stacked data output path
-        stacked_output_file_name = f"stacked-{datetime.date.today()}.csv"
-        stacked_output_path = os.path.join(default_output_dir, 'stacked', stacked_output_file_name)
-        stacked_excel_name = f"stacked-{datetime.date.today()}.xlsx"
-        stacked_excel_path = os.path.join(default_output_dir, 'stacked', stacked_excel_name)
-
-        # Writing down stacked data
-        stacked_data_df = stacked_data_df.reset_index(drop=True)
-        stacked_data_df.to_csv(stacked_output_path)
-        stacked_data_df.to_excel(stacked_excel_path)
+    # Cache of generation outputs from earlier runs
+    cache = None
+    fingerprint = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 ** 2)
+        fingerprint = model_fingerprint()
+
+    # Outputs are written in the background while the next generation is computed
+    with BackgroundWriter(max_pending=args.writer_queue_size) as writer:
+        # Iterating over files
+        for input_file_name in filenames:
+            # Skip temporary excel files
+            if "~$" in input_file_name:
+                continue
+
+            input_path = os.path.join(default_input_dir, input_file_name)
+
+            input_df = pd.read_excel(input_path, header=0, converters=CONVERTING_MAP)
+            input_df = input_df.rename(mapper=RENAMING_MAP, axis="columns")
+
+            # Meta-data information df
+            metadata_df = pd.read_excel(input_path, sheet_name="Meta-data")
+
+            # Experiment identifier
+            experiment_core_identifier = input_file_name.split('.')[0]
+
+            # Deltas information df
+            deltas_information_df = pd.read_excel(input_path, sheet_name="deltas_for_design")
+            deltas_dict = deltas_information_df.loc[0].to_dict()
+            delta_names = list(deltas_dict.keys())
+            delta_amplitudes = np.array(list(deltas_dict.values()), dtype=np.float64)
+
+            # Factors chosen in the design
+            design_input_columns = list(input_df.columns)
+            # List of all possible factors
+            input_columns = ALL_FACTORS
+            # Set of factors not chosen in the design
+            const_input_columns = set(input_columns) - set(design_input_columns)
+            for gen_idx in range(generations):
+
+                experiment_identifier = experiment_core_identifier + f"-generation_{gen_idx}"
+
+                # Insert file_name into meta-data df
+                metadata_df['Experiment Identifier'] = experiment_identifier
+
+                # Output paths
+                default_output_file_name = f"output-{experiment_identifier}.xlsx"
+                default_output_path = os.path.join(default_output_dir, 'xlsx', default_output_file_name)
+
+                csv_output_file_name = f"output-{experiment_identifier}.csv"
+                csv_output_path = os.path.join(default_output_dir, 'csv', csv_output_file_name)
+
+                metadata_output_file_name = f"output-{experiment_identifier}.csv"
+                metadata_output_path = os.path.join(default_output_dir, 'metadata', metadata_output_file_name)
+
+                output_paths = {
+                    "xlsx": default_output_path,
+                    "csv": csv_output_path,
+                    "metadata": metadata_output_path
+                }
+
+                # Reuse outputs of an identical earlier run
+                cache_key = None
+                if cache is not None:
+                    cache_key = get_cache_key(
+                        design=experiment_core_identifier,
+                        input_df=input_df,
+                        deltas_dict=deltas_dict,
+                        metadata_df=metadata_df,
+                        seed=args.seed,
+                        generation=gen_idx,
+                        fingerprint=fingerprint
+                    )
+                    output_df = cache.restore(cache_key, output_paths)
+                    if output_df is not None:
+                        stacked_data_df = stack_outputs(stacked_data_df, output_df)
+                        experiments_count += 1
+                        continue
+
+                outputs_only = []
+                io_only = []
+                extended_ls = []
+
+                # Draw deltas of all the rows of the generation at once,
+                # every row can be regenerated from (seed, design, generation, row) alone
+                relative_deltas = sample_relative_deltas(
+                    amplitudes=delta_amplitudes,
+                    design=experiment_core_identifier,
+                    generation=gen_idx,
+                    row_start=0,
+                    row_stop=len(input_df),
+                    seed=args.seed
+                )
+
+                output_columns = None
+                for row_position, (index, df_row) in enumerate(input_df.iterrows()):
+                    fl_model = FullSimulationConfig(**df_row.to_dict())
+
+                    # Wear out (lower stiffness of) bungee rope
+                    fl_model.spring_constant = fl_model.spring_constant * BUNGEE_WEAR_FACTOR**gen_idx
+                    print(experiments_count, "/", len(filenames))
+
+                    # Necessary data for simulation
+                    input_dict = {k: v for k, v in fl_model.model_dump().items() if 'delta' not in k}
+
+                    # Data going to output files
+                    chosen_deltas = {}
+                    initial_inputs = input_dict.copy()
+                    initial_inputs['Experiment Identifier'] = metadata_df.loc[0, 'Experiment Identifier']
+
+                    for k_delta, relative_delta in zip(delta_names, relative_deltas[row_position]):
+                        chosen_deltas[f"{k_delta}_chosen"] = float(relative_delta)
+
+                    # Apply deltas and adjust firing and release angles
+                    # due to difference of starting point and direction of angle calculation
+                    input_dict = apply_relative_deltas(input_dict, delta_names, relative_deltas[row_position])
+
+                    # Leave empty erroring experiments
+                    try:
+                        output_simulation = simulate(input_dict)
+
+                    except ValueError as e:
+                        output_simulation = {
+                            "x_ground": "",
+                            "y_ground": "",
+                            "z_ground": "",
+                            "max_height": ""
+                        }
+
+                    # Set output columns names
+                    if output_columns is None:
+                        output_columns = output_simulation.keys()
+
+                    output_simulation['Index'] = index
+
+                    io_data = {**output_simulation, **initial_inputs}
+                    extended_data = {**io_data, **chosen_deltas}
+
+                    outputs_only.append(output_simulation)
+                    io_only.append(io_data)
+                    extended_ls.append(extended_data)
+
+                assert output_columns is not None, "Column names for the outputs were not inferred"
+
+                # Writing down data
+                output_df = pd.DataFrame(
+                    io_only,
+                    columns=[
+                        *input_columns,
+                        *output_columns,
+                        'Experiment Identifier',
+                    ]
+                )
+                output_df.set_index('Index', inplace=True)
+                output_df = output_df.rename(REVERSE_NAMING_MAP, axis='columns')
+
+                # Stacking data in all runs data file
+                stacked_data_df = stack_outputs(stacked_data_df, output_df)
+
+                extended_df = pd.DataFrame(extended_ls)
+                extended_df.set_index('Index', inplace=True)
+
+                # Meta-data df is modified by the next generation, so a copy is written
+                writer.submit(
+                    write_generation_outputs,
+                    output_paths,
+                    output_df,
+                    extended_df,
+                    metadata_df.copy(),
+                    cache,
+                    cache_key
+                )
+
+                experiments_count += 1
+
+            # Stacked data output path
+            stacked_output_file_name = f"stacked-{datetime.date.today()}.csv"
+            stacked_output_path = os.path.join(default_output_dir, 'stacked', stacked_output_file_name)
+            stacked_excel_name = f"stacked-{datetime.date.today()}.xlsx"
+            stacked_excel_path = os.path.join(default_output_dir, 'stacked', stacked_excel_name)
+
+            # Writing down stacked data
+            stacked_data_df = stacked_data_df.reset_index(drop=True)
+            writer.submit(stacked_data_df.to_csv, stacked_output_path)
+            writer.submit(stacked_data_df.to_excel, stacked_excel_path)
 
     print("===============================-Success!-===============================")
     print(f"Data has been generated for {experiments_count} experiments")
@@ -0,0 +1,440 @@
+from typing import Optional
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import socket
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+from app.configured_shot import simulate_batch
+from app.models import FullSimulationConfig
+from app.sampling import DEFAULT_SEED, apply_relative_deltas, sample_relative_deltas
+from app.simulate import ALL_FACTORS, BUNGEE_WEAR_FACTOR, CONVERTING_MAP, RENAMING_MAP, REVERSE_NAMING_MAP
+
+
+OUTPUT_NAMES = ("x_ground", "y_ground", "z_ground", "max_height")
+
+# Default locations, independent of the directory the sweep is started from
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "simulations")
+
+# Seconds after which a claimed shard without heartbeat is considered dead and is handed out again
+DEFAULT_LEASE = 600.0
+
+# Amount of failed attempts after which a shard is not retried anymore
+DEFAULT_MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS study (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    design TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    replicate_start INTEGER NOT NULL,
+    replicate_stop INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',         -- pending / claimed / done / failed
+    worker TEXT,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result_path TEXT,
+    UNIQUE (design, generation, replicate_start)
+);
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """
+    Opens the work queue. Transactions are managed explicitly, so claims are atomic across processes and hosts
+    :param db_path: str, path to the SQLite database, on a file system shared by all the workers
+    :return: connection: sqlite3.Connection
+    """
+    connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA busy_timeout = 60000")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def to_stored_path(db_path: str, path: str) -> str:
+    """
+    Returns path relative to the directory of the database, so hosts mounting the shared directory
+    at different locations resolve it the same way
+    """
+    return os.path.relpath(os.path.abspath(path), start=os.path.dirname(os.path.abspath(db_path)))
+
+
+def resolve_stored_path(db_path: str, stored_path: str) -> str:
+    """
+    Returns local path of a path stored by to_stored_path
+    """
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(db_path)), stored_path))
+
+
+def get_study(connection: sqlite3.Connection) -> dict:
+    return {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM study")}
+
+
+def read_design(input_path: str) -> tuple[pd.DataFrame, pd.DataFrame, dict]:
+    """
+    Reads a raw design file the same way simulate.py does
+    :param input_path: str, path to the design workbook
+    :return: (input_df, metadata_df, deltas_dict): tuple[pd.DataFrame, pd.DataFrame, dict]
+    """
+    input_df = pd.read_excel(input_path, header=0, converters=CONVERTING_MAP)
+    input_df = input_df.rename(mapper=RENAMING_MAP, axis="columns")
+    metadata_df = pd.read_excel(input_path, sheet_name="Meta-data")
+    deltas_dict = pd.read_excel(input_path, sheet_name="deltas_for_design").loc[0].to_dict()
+    return input_df, metadata_df, deltas_dict
+
+
+def create_study(
+        db_path: str,
+        input_dir: str,
+        results_dir: str,
+        generations: int = 4,
+        replicates: int = 1,
+        block_size: int = 1,
+        seed: int = DEFAULT_SEED
+) -> int:
+    """
+    Splits the study (designs x generations x replicate blocks) into shards and puts them on the queue.
+    Creating a study again over the same database only adds shards which are not there yet.
+    :param db_path: str, path to the SQLite database
+    :param input_dir: str, directory with the raw design workbooks
+    :param results_dir: str, directory the shard results are written to
+    :param generations: int, amount of generations
+    :param replicates: int, amount of replicates of every design row, replicate 0 is the one simulate.py produces
+    :param block_size: int, amount of replicates per shard
+    :param seed: int, seed of the delta sampling
+    :return: shards_count: int, amount of shards in the queue
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    connection = connect(db_path)
+    study = {
+        "input_dir": to_stored_path(db_path, input_dir),
+        "results_dir": to_stored_path(db_path, results_dir),
+        "generations": generations,
+        "replicates": replicates,
+        "block_size": block_size,
+        "seed": seed
+    }
+    existing_study = get_study(connection)
+    assert not existing_study or existing_study == study, "Database already holds a different study."
+
+    filenames = sorted(glob.glob("*.xlsx", root_dir=input_dir))
+    connection.execute("BEGIN IMMEDIATE")
+    for key, value in study.items():
+        connection.execute("INSERT OR IGNORE INTO study (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    for input_file_name in filenames:
+        # Skip temporary excel files
+        if "~$" in input_file_name:
+            continue
+
+        for generation in range(generations):
+            for replicate_start in range(0, replicates, block_size):
+                connection.execute(
+                    "INSERT OR IGNORE INTO shards (design, input_path, generation, replicate_start, replicate_stop) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        input_file_name.split('.')[0],
+                        to_stored_path(db_path, os.path.join(input_dir, input_file_name)),
+                        generation,
+                        replicate_start,
+                        min(replicate_start + block_size, replicates)
+                    )
+                )
+    connection.execute("COMMIT")
+
+    shards_count = connection.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+    connection.close()
+    return shards_count
+
+
+def claim_shard(connection: sqlite3.Connection, worker: str, lease: float, max_attempts: int) -> Optional[sqlite3.Row]:
+    """
+    Atomically claims a pending shard or a claimed one whose worker stopped sending heartbeats
+    :return: shard: Optional[sqlite3.Row], None if there is nothing left to claim
+    """
+    connection.row_factory = sqlite3.Row
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        # Dead shards which used up all their attempts are not retried anymore
+        connection.execute(
+            "UPDATE shards SET status = 'failed', error = 'Worker stopped sending heartbeats.' "
+            "WHERE status = 'claimed' AND heartbeat < ? AND attempts >= ?",
+            (now - lease, max_attempts)
+        )
+        shard = connection.execute(
+            "SELECT * FROM shards "
+            "WHERE (status = 'pending' OR (status = 'claimed' AND heartbeat < ?)) AND attempts < ? "
+            "ORDER BY id LIMIT 1",
+            (now - lease, max_attempts)
+        ).fetchone()
+        if shard is not None:
+            connection.execute(
+                "UPDATE shards SET status = 'claimed', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now, shard["id"])
+            )
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+    return shard
+
+
+def heartbeat(connection: sqlite3.Connection, shard_id: int, worker: str) -> None:
+    connection.execute(
+        "UPDATE shards SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'claimed'",
+        (time.time(), shard_id, worker)
+    )
+
+
+def run_shard(shard: sqlite3.Row, study: dict, designs: dict, db_path: str, on_block=None) -> pd.DataFrame:
+    """
+    Simulates all the replicates of a shard.
+    Replicate r of row i is sampled as row r * rows + i of the (design, generation) stream,
+    so replicate 0 gets exactly the deltas simulate.py draws, and a shard does not depend on any other shard.
+    :param shard: sqlite3.Row, claimed shard
+    :param study: dict, study parameters
+    :param designs: dict, cache of designs read by the worker, by input path
+    :param db_path: str, path to the SQLite database, stored paths are relative to its directory
+    :param on_block: Optional[Callable[[], None]], called after every replicate, e.g. to send heartbeats
+    :return: shard_df: pd.DataFrame, inputs before deltas, outputs, identifiers
+    """
+    if shard["input_path"] not in designs:
+        designs[shard["input_path"]] = read_design(resolve_stored_path(db_path, shard["input_path"]))
+    input_df, _, deltas_dict = designs[shard["input_path"]]
+
+    generation = shard["generation"]
+    inputs = []
+    for _, df_row in input_df.iterrows():
+        fl_model = FullSimulationConfig(**df_row.to_dict())
+        # Wear out (lower stiffness of) bungee rope
+        fl_model.spring_constant = fl_model.spring_constant * BUNGEE_WEAR_FACTOR**generation
+        inputs.append({k: v for k, v in fl_model.model_dump().items() if 'delta' not in k})
+
+    input_dict = {name: np.array([row[name] for row in inputs]) for name in inputs[0]}
+    delta_names = list(deltas_dict.keys())
+    amplitudes = np.array(list(deltas_dict.values()), dtype=np.float64)
+    rows = len(input_df)
+
+    frames = []
+    for replicate in range(shard["replicate_start"], shard["replicate_stop"]):
+        relative_deltas = sample_relative_deltas(
+            amplitudes=amplitudes,
+            design=shard["design"],
+            generation=generation,
+            row_start=replicate * rows,
+            row_stop=(replicate + 1) * rows,
+            seed=study["seed"]
+        )
+        outputs = simulate_batch(apply_relative_deltas(input_dict, delta_names, relative_deltas))
+
+        experiment_identifier = shard["design"] + f"-generation_{generation}"
+        if replicate > 0:
+            experiment_identifier += f"-replicate_{replicate}"
+
+        replicate_df = pd.DataFrame({name: input_dict[name] for name in ALL_FACTORS})
+        for name in OUTPUT_NAMES:
+            replicate_df[name] = outputs[name]
+        replicate_df["Experiment Identifier"] = experiment_identifier
+        replicate_df["Replicate"] = replicate
+        replicate_df["Index"] = input_df.index
+        frames.append(replicate_df)
+
+        if on_block is not None:
+            on_block()
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def work(
+        db_path: str,
+        worker: Optional[str] = None,
+        lease: float = DEFAULT_LEASE,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS
+) -> int:
+    """
+    Claims and runs shards until the queue is drained. Any amount of workers on any amount of hosts may run at once
+    :param db_path: str, path to the SQLite database
+    :param worker: Optional[str], worker identifier, host name and process id by default
+    :param lease: float, seconds without heartbeat after which a shard of a dead worker is retried
+    :param max_attempts: int, amount of attempts per shard
+    :return: shards_done: int, amount of shards run by this worker
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    connection = connect(db_path)
+    study = get_study(connection)
+    designs = {}
+    shards_done = 0
+
+    while True:
+        shard = claim_shard(connection, worker, lease=lease, max_attempts=max_attempts)
+        if shard is None:
+            break
+
+        try:
+            shard_df = run_shard(
+                shard, study, designs, db_path, on_block=lambda: heartbeat(connection, shard["id"], worker)
+            )
+
+            # Written aside and renamed, so a killed worker never leaves a partial result
+            result_path = os.path.join(study["results_dir"], f"shard-{shard['id']}.pkl")
+            local_result_path = resolve_stored_path(db_path, result_path)
+            temp_path = f"{local_result_path}.{worker}.tmp"
+            shard_df.to_pickle(temp_path)
+            os.replace(temp_path, local_result_path)
+        except Exception as e:
+            status = "failed" if shard["attempts"] + 1 >= max_attempts else "pending"
+            connection.execute(
+                "UPDATE shards SET status = ?, error = ? WHERE id = ? AND worker = ?",
+                (status, repr(e), shard["id"], worker)
+            )
+            print(f"Shard {shard['id']} failed: {e!r}")
+            continue
+
+        # A worker whose lease expired must not overwrite the shard claimed again by another worker
+        updated = connection.execute(
+            "UPDATE shards SET status = 'done', result_path = ?, error = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'claimed'",
+            (result_path, shard["id"], worker)
+        ).rowcount
+        if updated == 0:
+            print(f"Shard {shard['id']} was claimed by another worker meanwhile")
+            continue
+
+        shards_done += 1
+        print(f"Shard {shard['id']} done: {shard['design']}, generation {shard['generation']}, "
+              f"replicates {shard['replicate_start']}-{shard['replicate_stop'] - 1}")
+
+    connection.close()
+    return shards_done
+
+
+def reset_failed(db_path: str) -> int:
+    """
+    Puts failed shards back on the queue with a fresh amount of attempts
+    :return: shards_count: int, amount of shards put back
+    """
+    connection = connect(db_path)
+    shards_count = connection.execute(
+        "UPDATE shards SET status = 'pending', attempts = 0, worker = NULL WHERE status = 'failed'"
+    ).rowcount
+    connection.close()
+    return shards_count
+
+
+def get_progress(db_path: str) -> dict:
+    """
+    Returns amount of shards per status
+    """
+    connection = connect(db_path)
+    progress = dict(connection.execute("SELECT status, COUNT(*) FROM shards GROUP BY status").fetchall())
+    connection.close()
+    return progress
+
+
+def reduce_study(db_path: str, output_dir: str) -> pd.DataFrame:
+    """
+    Merges results of all the shards into the stacked outputs simulate.py produces
+    (designs, then generations, then replicates, then design rows)
+    :param db_path: str, path to the SQLite database
+    :param output_dir: str, directory the stacked csv and xlsx files are written to
+    :return: stacked_data_df: pd.DataFrame
+    """
+    connection = connect(db_path)
+    shards = connection.execute(
+        "SELECT status, result_path FROM shards ORDER BY design, generation, replicate_start"
+    ).fetchall()
+    connection.close()
+
+    unfinished = sum(status != "done" for status, _ in shards)
+    assert unfinished == 0, f"{unfinished} shards are not done yet, run more workers before reducing."
+
+    stacked_data_df = pd.concat(
+        [pd.read_pickle(resolve_stored_path(db_path, result_path)) for _, result_path in shards],
+        ignore_index=True
+    )
+    stacked_data_df = stacked_data_df[[*ALL_FACTORS, *OUTPUT_NAMES, "Experiment Identifier"]]
+    stacked_data_df = stacked_data_df.rename(REVERSE_NAMING_MAP, axis="columns")
+
+    # Stacked data output path
+    os.makedirs(output_dir, exist_ok=True)
+    stacked_output_path = os.path.join(output_dir, f"stacked-{datetime.date.today()}.csv")
+    stacked_excel_path = os.path.join(output_dir, f"stacked-{datetime.date.today()}.xlsx")
+
+    stacked_data_df.to_csv(stacked_output_path)
+    stacked_data_df.to_excel(stacked_excel_path)
+    return stacked_data_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db", default=os.path.join(DATA_DIR, "sweep", "sweep.db"),
+        help="provide path to the work queue"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="split the study into shards")
+    init_parser.add_argument("--input-dir", default=os.path.join(DATA_DIR, "raw"), help="directory with raw designs")
+    init_parser.add_argument(
+        "--results-dir", default=os.path.join(DATA_DIR, "sweep", "shards"),
+        help="directory of shard results"
+    )
+    init_parser.add_argument("--generations", type=int, default=4, help="amount of generations")
+    init_parser.add_argument("--replicates", type=int, default=1, help="amount of replicates of every design row")
+    init_parser.add_argument("--block-size", type=int, default=1, help="amount of replicates per shard")
+    init_parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="seed of the delta sampling")
+
+    work_parser = subparsers.add_parser("work", help="run shards until the queue is drained")
+    work_parser.add_argument("--worker", default=None, help="worker identifier")
+    work_parser.add_argument(
+        "--lease", type=float, default=DEFAULT_LEASE,
+        help="seconds before a silent shard is retried"
+    )
+    work_parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="attempts per shard")
+
+    subparsers.add_parser("status", help="print amount of shards per status")
+    subparsers.add_parser("retry-failed", help="put failed shards back on the queue")
+
+    reduce_parser = subparsers.add_parser("reduce", help="merge shard results into stacked outputs")
+    reduce_parser.add_argument(
+        "--output-dir", default=os.path.join(DATA_DIR, "generated", "stacked"),
+        help="output directory"
+    )
+
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+
+    if args.command == "init":
+        count = create_study(
+            args.db,
+            input_dir=args.input_dir,
+            results_dir=args.results_dir,
+            generations=args.generations,
+            replicates=args.replicates,
+            block_size=args.block_size,
+            seed=args.seed
+        )
+        print(f"Study has {count} shards")
+    elif args.command == "work":
+        print(f"Worker ran {work(args.db, args.worker, lease=args.lease, max_attempts=args.max_attempts)} shards")
+    elif args.command == "status":
+        print(get_progress(args.db))
+    elif args.command == "retry-failed":
+        print(f"{reset_failed(args.db)} failed shards are put back on the queue")
+    elif args.command == "reduce":
+        stacked_df = reduce_study(args.db, args.output_dir)
+        print(f"Stacked {len(stacked_df)} rows into {os.path.abspath(args.output_dir)}")